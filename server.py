@@ -5,121 +5,237 @@ Remplace PeerJS pour la découverte et connexion des peers WebRTC
 """
 
 import asyncio
-import json
 import logging
+import os
+import re
+import uuid
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import Awaitable, Callable, Coroutine, Iterable, Optional
+import orjson
 import websockets
 from websockets.server import WebSocketServerProtocol
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    import uvloop  # Boucle libuv, non disponible sous Windows
+except ImportError:
+    uvloop = None
+
+# LOG_LEVEL=WARNING en production : les logs par connexion restent en INFO
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# getLevelName renvoie le niveau numérique pour un nom connu, une chaîne sinon
+# (équivalent de getLevelNamesMapping, absent avant Python 3.11)
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(
+    level=LOG_LEVEL if _log_level_valid else logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning("Invalid LOG_LEVEL %r, falling back to INFO", LOG_LEVEL)
 
-@dataclass
+HOST = "0.0.0.0"
+PORT = 8765
+
+# peer_id acceptés au register : bornés en taille et insérables tels quels
+# dans une chaîne JSON (aucun échappement)
+SAFE_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+# Trames en attente par peer avant de considérer le client comme bloqué
+OUTBOUND_QUEUE_SIZE = 256
+
+# Seules deux raisons de fermeture existent : trames encodées une fois pour toutes
+ROOM_CLOSED_FRAMES: dict[str, bytes] = {
+    reason: orjson.dumps({"type": "room-closed", "reason": reason})
+    for reason in ("host-left", "empty")
+}
+
+def is_safe_id(peer_id) -> bool:
+    """Vérifie qu'un peer_id fourni par le client est acceptable"""
+    return isinstance(peer_id, str) and SAFE_ID_RE.fullmatch(peer_id) is not None
+
+def peer_joined_frame(peer_id: str, username) -> bytes:
+    """Trame peer-joined encodée (peer_id validé au register)"""
+    return (b'{"type":"peer-joined","peerId":"' + peer_id.encode()
+            + b'","username":' + orjson.dumps(username) + b'}')
+
+def peer_left_frame(peer_id: str) -> bytes:
+    """Trame peer-left encodée (peer_id validé au register)"""
+    return b'{"type":"peer-left","peerId":"' + peer_id.encode() + b'"}'
+
+@dataclass(slots=True)
 class Peer:
     """Représente un peer connecté"""
     ws: WebSocketServerProtocol
     peer_id: str
     username: str
     room: Optional[str] = None
-
-@dataclass
+    # Annoncé au register ("binary": true) : le client accepte des trames
+    # binaires (JSON UTF-8) regroupant plusieurs messages séparés par "\n".
+    # Les clients déjà déployés ne l'envoient pas et reçoivent un message
+    # JSON texte par trame.
+    binary: bool = False
+    # Trames encodées en attente d'envoi, vidées par writer_task
+    out_queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(OUTBOUND_QUEUE_SIZE))
+    writer_task: Optional[asyncio.Task] = None
+    # Connexion perdue ou client bloqué : plus aucune trame n'est mise en file
+    closing: bool = False
+
+@dataclass(slots=True)
 class Room:
     """Représente une room/salon"""
     code: str
     host_id: str
     peers: dict[str, Peer] = field(default_factory=dict)
 
+class PeerStateError(RuntimeError):
+    """ws.peer_id et self.peers ne se correspondent plus (bug serveur)"""
+
+async def close_quietly(ws: WebSocketServerProtocol):
+    """Ferme une connexion en ignorant les erreurs"""
+    try:
+        await ws.close()
+    except Exception:
+        pass
+
+async def peer_writer(peer: Peer):
+    """Envoie les trames de la file sortante d'un peer.
+
+    Pour les clients binaires (Peer.binary), les trames accumulées pendant un
+    envoi sont fusionnées en une seule, séparées par des sauts de ligne
+    (jamais présents bruts dans du JSON encodé).
+    """
+    queue = peer.out_queue
+    binary = peer.binary
+    while True:
+        payload = await queue.get()
+        if binary and not queue.empty():
+            batch = [payload]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            payload = b"\n".join(batch)
+        try:
+            await peer.ws.send(payload if binary else payload.decode())
+        except websockets.exceptions.ConnectionClosed:
+            # handle_connection fera le ménage ; d'ici là on ne bufferise plus
+            peer.closing = True
+            return
+
 class SignalingServer:
     def __init__(self):
         self.peers: dict[str, Peer] = {}  # peer_id -> Peer
         self.rooms: dict[str, Room] = {}  # room_code -> Room
-        self.ws_to_peer: dict[WebSocketServerProtocol, str] = {}  # ws -> peer_id
+        self._background_tasks: set[asyncio.Task] = set()
+        # msg_type -> handler(ws, data, peer)
+        self._handlers: dict[str, Callable[..., Awaitable[None]]] = {
+            "register": self.handle_register,
+            "host": self.handle_host,
+            "join": self.handle_join,
+            "signal": self.handle_signal,
+            "broadcast": self.handle_broadcast,
+            "message": self.handle_direct_message,
+            "leave": self.handle_leave,
+        }
 
     async def handle_connection(self, ws: WebSocketServerProtocol):
         """Gère une nouvelle connexion WebSocket"""
         peer_id = None
+        loads = orjson.loads
+        handle_message = self.handle_message
         try:
+            # Quand des trames sont déjà en file, l'itération les dépile sans
+            # repasser par la boucle d'événements : on garde ce corps minimal
             async for message in ws:
                 try:
-                    data = json.loads(message)
-                    peer_id = await self.handle_message(ws, data)
-                except json.JSONDecodeError:
+                    data = loads(message)
+                    if not isinstance(data, dict):
+                        await self.send_error(ws, "Invalid message")
+                        continue
+                    peer_id = await handle_message(ws, data)
+                except orjson.JSONDecodeError:
                     await self.send_error(ws, "Invalid JSON")
-                except Exception as e:
-                    logger.error(f"Error handling message: {e}")
-                    await self.send_error(ws, str(e))
+                except (KeyError, ValueError, TypeError) as e:
+                    # Champs manquants ou de mauvais type dans le message
+                    logger.warning("Invalid message from %s: %r", peer_id, e)
+                    await self.send_error(ws, "Invalid message")
+                except Exception:
+                    # Bug côté serveur : on logge la trace sans l'exposer au client
+                    logger.exception("Error handling message")
+                    await self.send_error(ws, "Internal error")
         except websockets.exceptions.ConnectionClosed:
-            logger.info(f"Connection closed for peer: {peer_id}")
+            logger.info("Connection closed for peer: %s", peer_id)
         finally:
+            # ws.peer_id est remis à None si le peer a déjà été déconnecté
+            # (leave, ou même peer_id ré-enregistré sur une autre connexion)
+            peer_id = getattr(ws, "peer_id", None)
             if peer_id:
                 await self.handle_disconnect(peer_id)
 
     async def handle_message(self, ws: WebSocketServerProtocol, data: dict) -> Optional[str]:
         """Traite un message entrant"""
         msg_type = data.get("type")
-        peer_id = self.ws_to_peer.get(ws)
-
-        if msg_type == "register":
-            return await self.handle_register(ws, data)
-        elif msg_type == "host":
-            return await self.handle_host(ws, data, peer_id)
-        elif msg_type == "join":
-            return await self.handle_join(ws, data, peer_id)
-        elif msg_type == "signal":
-            await self.handle_signal(data, peer_id)
-        elif msg_type == "broadcast":
-            await self.handle_broadcast(data, peer_id)
-        elif msg_type == "message":
-            await self.handle_direct_message(data, peer_id)
-        elif msg_type == "leave":
-            await self.handle_leave(peer_id)
-        else:
+        handler = self._handlers.get(msg_type)
+        if handler is None:
             await self.send_error(ws, f"Unknown message type: {msg_type}")
+            return getattr(ws, "peer_id", None)
 
-        return peer_id
+        # Peer résolu une seule fois ici, puis passé tel quel aux handlers
+        peer_id = getattr(ws, "peer_id", None)
+        peer = self.peers.get(peer_id) if peer_id else None
+        if peer_id and peer is None:
+            # Bug serveur, pas une erreur du client : remonté en "Internal error"
+            raise PeerStateError(f"ws.peer_id {peer_id!r} has no registered Peer")
+        await handler(ws, data, peer)
 
-    async def handle_register(self, ws: WebSocketServerProtocol, data: dict) -> str:
+        # register et leave changent le peer_id associé à la connexion
+        return getattr(ws, "peer_id", None)
+
+    async def handle_register(self, ws: WebSocketServerProtocol, data: dict, current: Optional[Peer]):
         """Enregistre un nouveau peer"""
         peer_id = data.get("peerId")
         username = data.get("username", "Inconnu")
 
+        if peer_id and not is_safe_id(peer_id):
+            await self.send_error(ws, "Invalid peer id")
+            return
+
         if not peer_id:
-            import uuid
-            peer_id = str(uuid.uuid4())[:8]
+            peer_id = uuid.uuid4().hex[:8]
 
-        # Si ce peer_id existe déjà, le déconnecter
-        if peer_id in self.peers:
-            old_peer = self.peers[peer_id]
+        # Connexion déjà enregistrée : on libère l'ancienne identité, sans
+        # fermer la connexion (ws.peer_id ne doit désigner qu'un seul Peer)
+        if current is not None:
+            await self.handle_disconnect(current.peer_id)
+
+        # Si ce peer_id existe déjà sur une autre connexion, la déconnecter
+        old_peer = self.peers.get(peer_id)
+        if old_peer is not None:
             await self.handle_disconnect(peer_id)
-            try:
-                await old_peer.ws.close()
-            except:
-                pass
+            # Le handshake de fermeture peut durer jusqu'à ping_timeout :
+            # on ne fait pas attendre le nouveau client
+            self.spawn(close_quietly(old_peer.ws))
 
-        peer = Peer(ws=ws, peer_id=peer_id, username=username)
+        peer = Peer(ws=ws, peer_id=peer_id, username=username, binary=data.get("binary") is True)
+        peer.writer_task = asyncio.create_task(peer_writer(peer))
         self.peers[peer_id] = peer
-        self.ws_to_peer[ws] = peer_id
+        ws.peer_id = peer_id
 
-        logger.info(f"Peer registered: {peer_id} ({username})")
+        logger.info("Peer registered: %s (%s)", peer_id, username)
 
-        await self.send(ws, {
+        self.enqueue(peer, orjson.dumps({
             "type": "registered",
             "peerId": peer_id
-        })
+        }))
 
-        return peer_id
-
-    async def handle_host(self, ws: WebSocketServerProtocol, data: dict, peer_id: str) -> str:
+    async def handle_host(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Crée une nouvelle room en tant qu'hôte"""
-        if not peer_id:
+        if peer is None:
             await self.send_error(ws, "Must register first")
-            return peer_id
+            return
 
         room_code = data.get("room")
         if not room_code:
             await self.send_error(ws, "Room code required")
-            return peer_id
+            return
 
         # Vérifier si la room existe déjà
         if room_code in self.rooms:
@@ -128,82 +244,74 @@ class SignalingServer:
                 "error": "room-exists",
                 "message": "Ce code serveur est déjà utilisé"
             })
-            return peer_id
+            return
 
         # Créer la room
-        peer = self.peers[peer_id]
         peer.room = room_code
 
-        room = Room(code=room_code, host_id=peer_id)
-        room.peers[peer_id] = peer
+        room = Room(code=room_code, host_id=peer.peer_id)
+        room.peers[peer.peer_id] = peer
         self.rooms[room_code] = room
 
-        logger.info(f"Room created: {room_code} by {peer_id}")
+        logger.info("Room created: %s by %s", room_code, peer.peer_id)
 
-        await self.send(ws, {
+        self.enqueue(peer, orjson.dumps({
             "type": "hosted",
             "room": room_code
-        })
-
-        return peer_id
+        }))
 
-    async def handle_join(self, ws: WebSocketServerProtocol, data: dict, peer_id: str) -> str:
+    async def handle_join(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Rejoint une room existante"""
-        if not peer_id:
+        if peer is None:
             await self.send_error(ws, "Must register first")
-            return peer_id
+            return
 
         room_code = data.get("room")
         if not room_code:
             await self.send_error(ws, "Room code required")
-            return peer_id
+            return
 
         # Vérifier si la room existe
-        if room_code not in self.rooms:
+        room = self.rooms.get(room_code)
+        if room is None:
             await self.send(ws, {
                 "type": "error",
                 "error": "room-not-found",
                 "message": "Serveur introuvable"
             })
-            return peer_id
+            return
 
-        room = self.rooms[room_code]
-        peer = self.peers[peer_id]
         peer.room = room_code
 
-        # Informer les autres peers de la room
-        existing_peers = []
-        for other_id, other_peer in room.peers.items():
-            existing_peers.append({
+        # Informer les autres peers de la room (payload identique, sérialisé une fois)
+        encoded = peer_joined_frame(peer.peer_id, peer.username)
+        existing_peers = [
+            {
                 "peerId": other_id,
                 "username": other_peer.username,
                 "isHost": other_id == room.host_id
-            })
-            # Notifier le peer existant du nouveau venu
-            await self.send(other_peer.ws, {
-                "type": "peer-joined",
-                "peerId": peer_id,
-                "username": peer.username
-            })
+            }
+            for other_id, other_peer in room.peers.items()
+        ]
+        # Notifier les peers existants du nouveau venu
+        self.fanout(room.peers.values(), encoded)
 
         # Ajouter le peer à la room
-        room.peers[peer_id] = peer
+        room.peers[peer.peer_id] = peer
 
-        logger.info(f"Peer {peer_id} joined room {room_code}")
+        logger.info("Peer %s joined room %s", peer.peer_id, room_code)
 
         # Envoyer la confirmation avec la liste des peers
-        await self.send(ws, {
+        self.enqueue(peer, orjson.dumps({
             "type": "joined",
             "room": room_code,
             "peers": existing_peers,
             "hostId": room.host_id
-        })
-
-        return peer_id
+        }))
 
-    async def handle_signal(self, data: dict, peer_id: str):
+    async def handle_signal(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Relaye un signal WebRTC (offer/answer/ice) à un peer"""
-        if not peer_id:
+        if peer is None:
             return
 
         target_id = data.get("to")
@@ -212,103 +320,150 @@ class SignalingServer:
         if not target_id or not signal_data:
             return
 
-        if target_id not in self.peers:
-            logger.warning(f"Signal target not found: {target_id}")
+        target = self.peers.get(target_id)
+        if target is None:
+            logger.warning("Signal target not found: %s", target_id)
             return
 
-        target = self.peers[target_id]
-        await self.send(target.ws, {
+        # Chemin le plus fréquent (rafales d'ICE candidates) : une seule
+        # recherche, encodage direct dans la file du destinataire
+        self.enqueue(target, orjson.dumps({
             "type": "signal",
-            "from": peer_id,
+            "from": peer.peer_id,
             "data": signal_data
-        })
+        }))
 
-    async def handle_broadcast(self, data: dict, peer_id: str):
+    async def handle_broadcast(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Broadcast un message à tous les peers de la room"""
-        if not peer_id or peer_id not in self.peers:
+        if peer is None:
             return
 
-        peer = self.peers[peer_id]
-        if not peer.room or peer.room not in self.rooms:
+        room = self.rooms.get(peer.room)
+        if room is None:
             return
 
-        room = self.rooms[peer.room]
         message_data = data.get("data")
 
-        for other_id, other_peer in room.peers.items():
-            if other_id != peer_id:
-                await self.send(other_peer.ws, {
-                    "type": "broadcast",
-                    "from": peer_id,
-                    "data": message_data
-                })
+        # Sérialiser une seule fois pour tous les destinataires
+        encoded = orjson.dumps({
+            "type": "broadcast",
+            "from": peer.peer_id,
+            "data": message_data
+        })
+
+        # Mise en file par destinataire : un client lent ne bloque pas les autres
+        self.fanout(
+            (other_peer for other_peer in room.peers.values() if other_peer is not peer),
+            encoded
+        )
 
-    async def handle_direct_message(self, data: dict, peer_id: str):
+    async def handle_direct_message(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Envoie un message direct à un peer"""
-        if not peer_id:
+        if peer is None:
             return
 
         target_id = data.get("to")
         message_data = data.get("data")
 
-        if not target_id or target_id not in self.peers:
+        target = self.peers.get(target_id)
+        if target is None:
             return
 
-        target = self.peers[target_id]
-        await self.send(target.ws, {
+        self.enqueue(target, orjson.dumps({
             "type": "message",
-            "from": peer_id,
+            "from": peer.peer_id,
             "data": message_data
-        })
+        }))
 
-    async def handle_leave(self, peer_id: str):
+    async def handle_leave(self, ws: WebSocketServerProtocol, data: dict, peer: Optional[Peer]):
         """Gère le départ volontaire d'un peer"""
-        await self.handle_disconnect(peer_id)
+        if peer is not None:
+            await self.handle_disconnect(peer.peer_id)
 
     async def handle_disconnect(self, peer_id: str):
         """Gère la déconnexion d'un peer"""
-        if peer_id not in self.peers:
+        peer = self.peers.get(peer_id)
+        if peer is None:
             return
+        # Invariant : ws.peer_id est défini si et seulement si self.peers[peer_id]
+        # existe. Vérifié avant de toucher à l'état pour ne rien laisser à moitié
+        # nettoyé.
+        if peer.ws.peer_id != peer_id:
+            raise PeerStateError(
+                f"Peer {peer_id!r} is attached to a ws with peer_id {peer.ws.peer_id!r}"
+            )
 
-        peer = self.peers[peer_id]
         room_code = peer.room
 
         # Retirer de la room
-        if room_code and room_code in self.rooms:
-            room = self.rooms[room_code]
-            if peer_id in room.peers:
-                del room.peers[peer_id]
+        room = self.rooms.get(room_code)
+        if room is not None:
+            room.peers.pop(peer_id, None)
 
             # Notifier les autres peers
-            for other_id, other_peer in room.peers.items():
-                await self.send(other_peer.ws, {
-                    "type": "peer-left",
-                    "peerId": peer_id
-                })
+            encoded = peer_left_frame(peer_id)
+            self.fanout(room.peers.values(), encoded)
 
             # Si l'hôte part ou la room est vide, supprimer la room
             if peer_id == room.host_id or len(room.peers) == 0:
                 # Notifier tous les peers que la room ferme
-                for other_id, other_peer in list(room.peers.items()):
-                    await self.send(other_peer.ws, {
-                        "type": "room-closed",
-                        "reason": "host-left" if peer_id == room.host_id else "empty"
-                    })
+                encoded = ROOM_CLOSED_FRAMES["host-left" if peer_id == room.host_id else "empty"]
+                others = list(room.peers.values())
+                for other_peer in others:
                     other_peer.room = None
+                self.fanout(others, encoded)
                 del self.rooms[room_code]
-                logger.info(f"Room {room_code} closed")
+                logger.info("Room %s closed", room_code)
 
         # Nettoyer
-        if peer.ws in self.ws_to_peer:
-            del self.ws_to_peer[peer.ws]
+        if peer.writer_task is not None:
+            peer.writer_task.cancel()
+        peer.ws.peer_id = None
         del self.peers[peer_id]
 
-        logger.info(f"Peer disconnected: {peer_id}")
+        logger.info("Peer disconnected: %s", peer_id)
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        """Lance une tâche en arrière-plan en gardant une référence jusqu'à sa fin"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    def enqueue(self, peer: Peer, payload: bytes):
+        """Met une trame encodée dans la file sortante d'un peer"""
+        if peer.closing:
+            return
+        try:
+            peer.out_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # Client qui ne lit plus : on le coupe plutôt que de bufferiser
+            logger.warning("Outbound queue full, dropping peer: %s", peer.peer_id)
+            peer.closing = True
+            self.spawn(self.abort_peer(peer))
+
+    async def abort_peer(self, peer: Peer):
+        """Retire un peer bloqué et coupe sa connexion sans handshake de fermeture"""
+        # Lancé en tâche : enqueue peut être appelé pendant un fanout sur la room
+        if self.peers.get(peer.peer_id) is peer:
+            await self.handle_disconnect(peer.peer_id)
+        # Un close() propre attendrait derrière le buffer TCP plein
+        peer.ws.transport.abort()
+
+    def fanout(self, peers: Iterable[Peer], payload: bytes):
+        """Met la même trame encodée dans la file de plusieurs peers"""
+        for peer in peers:
+            self.enqueue(peer, payload)
 
     async def send(self, ws: WebSocketServerProtocol, data: dict):
-        """Envoie un message JSON"""
+        """Envoie un message JSON (via la file sortante si le peer est enregistré)"""
+        peer = self.peers.get(getattr(ws, "peer_id", None))
+        if peer is not None:
+            self.enqueue(peer, orjson.dumps(data))
+            return
+        # Avant le register, le format n'est pas négocié : trame texte
         try:
-            await ws.send(json.dumps(data))
+            await ws.send(orjson.dumps(data).decode())
         except websockets.exceptions.ConnectionClosed:
             pass
 
@@ -324,13 +479,19 @@ async def main():
 
     async with websockets.serve(
         server.handle_connection,
-        "0.0.0.0",
-        8765,
+        HOST,
+        PORT,
         ping_interval=30,
-        ping_timeout=10
+        ping_timeout=10,
+        # Messages de signaling : quelques Ko au plus (SDP), on plafonne la
+        # taille d'un message entrant (1 Mo par défaut)
+        max_size=16384
     ):
-        logger.info("Serveur de signaling démarré sur ws://0.0.0.0:8765")
+        logger.info("Serveur de signaling démarré sur ws://%s:%s", HOST, PORT)
         await asyncio.Future()  # Run forever
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
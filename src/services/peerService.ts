@@ -10,6 +10,8 @@ interface PeerMessage {
 // Configuration du serveur WebSocket de signaling
 const SIGNALING_SERVER = "wss://cabochards.duckdns.org";
 
+const textDecoder = new TextDecoder();
+
 // Configuration ICE avec serveurs STUN/TURN publics fiables
 const ICE_SERVERS: RTCIceServer[] = [
   { urls: "stun:stun.l.google.com:19302" },
@@ -111,6 +113,9 @@ class PeerService {
 
       console.log(`[Signaling] Connexion à ${SIGNALING_SERVER}...`);
       this.ws = new WebSocket(SIGNALING_SERVER);
+      // Après register avec binary: true, le serveur peut envoyer des
+      // trames binaires (JSON encodé en UTF-8)
+      this.ws.binaryType = "arraybuffer";
 
       const timeout = setTimeout(() => {
         reject(new Error("Connection timeout"));
@@ -137,7 +142,13 @@ class PeerService {
       };
 
       this.ws.onmessage = (event) => {
-        this.handleSignalingMessage(JSON.parse(event.data));
+        const text = typeof event.data === "string"
+          ? event.data
+          : textDecoder.decode(event.data as ArrayBuffer);
+        // Le serveur peut regrouper plusieurs messages, séparés par "\n"
+        for (const line of text.split("\n")) {
+          this.handleSignalingMessage(JSON.parse(line));
+        }
       };
     });
   }
@@ -449,6 +460,8 @@ class PeerService {
           type: "register",
           peerId: `host-${serverCode}`,
           username,
+          // Accepte les trames binaires et les messages regroupés
+          binary: true,
         });
 
         // Attendre l'enregistrement puis créer la room
@@ -509,6 +522,8 @@ class PeerService {
           type: "register",
           peerId: `guest-${randomId}`,
           username,
+          // Accepte les trames binaires et les messages regroupés
+          binary: true,
         });
 
         // Attendre l'enregistrement puis rejoindre